@@ -26,15 +26,14 @@ yassine.azma@rmh.nhs.uk
 
 import os
 import sys
+import math
 import traceback
 import numpy as np
-import matplotlib.pyplot as plot
-import scipy
-import skimage.morphology
-import skimage.measure
+import matplotlib.pyplot as plt
 
 from hazenlib.HazenTask import HazenTask
 from hazenlib.ACRObject import ACRObject
+from hazenlib.utils import GetDicomTag
 
 
 class ACRSlicePosition(HazenTask):
@@ -47,6 +46,11 @@ class ACRSlicePosition(HazenTask):
         super().__init__(**kwargs)
         # Initialise ACR object
         self.ACR_obj = ACRObject(self.dcm_list,kwargs)
+        # Contiguous uint8 copy of the ACR object mask, shared by the wedge search of both slices
+        self.mask_u8 = np.ascontiguousarray(self.ACR_obj.mask_image, dtype=np.uint8)
+        # Extent of the most recently used mask, reused while the same mask is passed in
+        self.mask_bounds_source = None
+        self.mask_bounds = None
 
     def run(self) -> dict:
         """Main function for performing slice position measurement
@@ -57,7 +61,6 @@ class ACRSlicePosition(HazenTask):
         """
         # Identify relevant slices
         dcms = [self.ACR_obj.dcms[0], self.ACR_obj.dcms[-1]]
-        #dcms = [dcms[-1]]
 
         # Initialise results dictionary
         results = self.init_result_dict()
@@ -83,6 +86,29 @@ class ACRSlicePosition(HazenTask):
 
         return results
 
+    def get_mask_bounds(self, mask):
+        """Find the westmost, eastmost and northmost points of the mask
+
+        The result is cached, so the stored mask of the ACR object is only scanned once for both slices.
+
+        Args:
+            mask (np.array): dcm.pixel_array of the image mask
+
+        Returns:
+            tuple: westmost, eastmost and northmost points of the mask
+        """
+        if mask is not self.mask_bounds_source:
+            col_any = np.any(mask, 0)
+            row_any = np.any(mask, 1)
+            w_point = int(np.argmax(col_any))
+            e_point = len(col_any) - 1 - int(np.argmax(col_any[::-1]))
+            n_point = int(np.argmax(row_any))
+
+            self.mask_bounds_source = mask
+            self.mask_bounds = (w_point, e_point, n_point)
+
+        return self.mask_bounds
+
     def find_wedges(self, img, mask, res):
         """Find wedges in the pixel array
 
@@ -95,38 +121,41 @@ class ACRSlicePosition(HazenTask):
             tuple: arrays of x and y coordinates of wedges
         """
         # X COORDINATES
-        x_investigate_region = np.ceil(35 / res[0]).astype(
-            int
+        x_investigate_region = math.ceil(
+            35 / res[0]
         )  # define width of region to test (comparable to wedges)
 
-        if np.mod(x_investigate_region, 2) == 0:
+        if x_investigate_region % 2 == 0:
             # we want an odd number to see -N to N points in the x direction
             x_investigate_region = x_investigate_region + 1
 
-        w_point = np.argwhere(np.sum(mask, 0) > 0)[0].item()  # westmost point of object
-        e_point = np.argwhere(np.sum(mask, 0) > 0)[-1].item()  # eastmost point of object
-        n_point = np.argwhere(np.sum(mask, 1) > 0)[0].item()  # northmost point of object
-
-        invest_x = []
-        for k in range(x_investigate_region):
-            y_loc = n_point + k  # add n_point to ensure in image's coordinate system
-            t = mask[
-                y_loc, np.arange(w_point, e_point + 1, 1)
-            ]  # mask for resultant line profile
-            # line profile at varying y positions from west to east
-            line_prof_x = skimage.measure.profile_line(
-                img, (y_loc, w_point), (y_loc, e_point), mode="constant"
-            ).flatten()
-
-            invest_x.append(t * line_prof_x)  # mask unwanted values out and append
-
-        invest_x = np.array(invest_x).T  # transpose array
-        mean_x_profile = np.mean(
-            invest_x, 1
-        )  # mean of horizontal projections of phantom
-        abs_diff_x_profile = np.abs(
-            np.diff(mean_x_profile)
-        )  # absolute first derivative of mean
+        # westmost, eastmost and northmost points of object
+        w_point, e_point, n_point = self.get_mask_bounds(mask)
+
+        # supposed distance from top of phantom to end of wedges
+        end_point = n_point + round(50 / res[1])
+        if (self.ACR_obj.MediumACRPhantom==True):
+            end_point = n_point + round(35 / res[1]) #This may need adjusted i'm not to confident that it will always work...
+
+        # buffer shared by the absolute first derivatives of the x and y mean profiles
+        abs_diff_buffer = np.empty(
+            max(e_point - w_point, end_point - n_point), dtype=np.float32
+        )
+
+        # horizontal line profiles from west to east at each y position in the region, taken as a single slice
+        # (stop at e_point + 1 to include the end point, as profile_line does)
+        rows = img[n_point : n_point + x_investigate_region, w_point : e_point + 1]
+        t = mask[
+            n_point : n_point + x_investigate_region, w_point : e_point + 1
+        ]  # mask for resultant line profiles
+
+        # mean of horizontal projections of phantom, masking unwanted values out in the same pass
+        mean_x_profile = np.einsum(
+            "ij,ij->j", t, rows, dtype=np.float32, casting="same_kind"
+        ) / np.float32(rows.shape[0])
+        abs_diff_x_profile = abs_diff_buffer[: len(mean_x_profile) - 1]
+        np.subtract(mean_x_profile[1:], mean_x_profile[:-1], out=abs_diff_x_profile)
+        np.abs(abs_diff_x_profile, out=abs_diff_x_profile)  # absolute first derivative of mean
 
         x_peaks, _ = self.ACR_obj.find_n_highest_peaks(
             abs_diff_x_profile, 2
@@ -136,57 +165,46 @@ class ACRSlicePosition(HazenTask):
         )  # x coordinates of these peaks in image coordinate system(before diff operation)
 
         width_pts = [x_locs[0], x_locs[1]]  # width of wedges
-        width = np.max(width_pts) - np.min(width_pts)  # width
+        width = max(width_pts) - min(width_pts)  # width
 
         # rough midpoints of wedges
         x_pts = np.round(
-            [np.min(width_pts) + 0.25 * width, np.max(width_pts) - 0.25 * width]
+            [min(width_pts) + 0.25 * width, max(width_pts) - 0.25 * width]
         ).astype(int)
 
         # Y COORDINATES
         # define height of region to test (comparable to wedges)
-        y_investigate_region = int(np.ceil(20 / res[1]).item())
-
-        # supposed distance from top of phantom to end of wedges
-        end_point = n_point + np.round(50 / res[1]).astype(int)
-        if (self.ACR_obj.MediumACRPhantom==True):
-            end_point = n_point + np.round(35 / res[1]).astype(int) #This may need adjusted i'm not to confident that it will always work...
+        y_investigate_region = math.ceil(20 / res[1])
 
-        if np.mod(y_investigate_region, 2) == 0:
+        if y_investigate_region % 2 == 0:
             # we want an odd number to see -N to N points in the y direction
             y_investigate_region = y_investigate_region + 1
-        import matplotlib.pyplot as plt
-        invest_y = []
-        for m in range(y_investigate_region):
-            x_loc = (
-                m - np.floor(y_investigate_region / 2) + np.floor(np.mean(x_pts))
-            ).astype(int)
-            c = mask[
-                np.arange(n_point, end_point + 1, 1), x_loc
-            ]  # mask for resultant line profile
 
-            line_prof_y = skimage.measure.profile_line(
-                img, (n_point, x_loc), (end_point, x_loc), mode="constant"
-            ).flatten() 
-            invest_y.append(c * line_prof_y)
-
-
-        invest_y = np.array(invest_y).T  # transpose array
-        mean_y_profile = np.mean(invest_y, 1)  # mean of vertical projections of phantom
-
-
-
-        abs_diff_y_profile = np.abs(
-            np.diff(mean_y_profile)
-        )  # absolute first derivative of mean
-       
+        # vertical line profiles from north to south at each x position either side of the wedges' midpoint,
+        # taken as a single slice (stop at end_point + 1 to include the end point, as profile_line does)
+        x_centre = (int(x_pts[0]) + int(x_pts[1])) // 2
+        half_region = y_investigate_region // 2
+        cols = img[
+            n_point : end_point + 1, x_centre - half_region : x_centre + half_region + 1
+        ]
+        c = mask[
+            n_point : end_point + 1, x_centre - half_region : x_centre + half_region + 1
+        ]  # mask for resultant line profiles
+
+        # mean of vertical projections of phantom, masking unwanted values out in the same pass
+        mean_y_profile = np.einsum(
+            "ij,ij->i", c, cols, dtype=np.float32, casting="same_kind"
+        ) / np.float32(cols.shape[1])
+
+        abs_diff_y_profile = abs_diff_buffer[: len(mean_y_profile) - 1]
+        np.subtract(mean_y_profile[1:], mean_y_profile[:-1], out=abs_diff_y_profile)
+        np.abs(abs_diff_y_profile, out=abs_diff_y_profile)  # absolute first derivative of mean
 
         y_peaks, _ = self.ACR_obj.find_n_highest_peaks(
             abs_diff_y_profile, 2
         )  # find two highest peaks
         y_locs = (
-            #w_point + y_peaks - 1
-            n_point + y_peaks - 1 #n_point was w_point ????
+            n_point + y_peaks - 1
         )  # y coordinates of these peaks in image coordinate system(before diff operation)
 
         if y_locs[1] - y_locs[0] < 5 / res[1]:
@@ -194,14 +212,14 @@ class ACRSlicePosition(HazenTask):
                 n_point + round(10 / res[1])
             ]  # if peaks too close together, use phantom geometry
         else:
-            y = np.round(
-                np.min(y_locs) + 0.25 * np.abs(np.diff(y_locs))
-            )  # define y coordinate
+            y = [
+                round(float(min(y_locs) + 0.25 * abs(y_locs[1] - y_locs[0])))
+            ]  # define y coordinate
 
-        dist_to_y = np.abs(n_point - y[0]) * res[1]  # distance to y from top of phantom
-        y_pts = np.append(y, np.round(y[0] + (47 - dist_to_y) / res[1])).astype(int)  # place 2nd y point 47mm from top of phantom
+        dist_to_y = abs(n_point - y[0]) * res[1]  # distance to y from top of phantom
+        y_pts = np.array([y[0], round(y[0] + (47 - dist_to_y) / res[1])])  # place 2nd y point 47mm from top of phantom
         if (self.ACR_obj.MediumACRPhantom == True):
-            y_pts = np.append(y, np.round(y[0] + (35 - dist_to_y) / res[1])).astype(int)  # place 2nd y point 35mm from top of phantom
+            y_pts = np.array([y[0], round(y[0] + (35 - dist_to_y) / res[1])])  # place 2nd y point 35mm from top of phantom
 
         return x_pts, y_pts
 
@@ -219,59 +237,47 @@ class ACRSlicePosition(HazenTask):
         if 'PixelSpacing' in dcm:
             res = dcm.PixelSpacing  # In-plane resolution from metadata
         else:
-            import hazenlib.utils
-            res = hazenlib.utils.GetDicomTag(dcm,(0x28,0x30))
+            res = GetDicomTag(dcm,(0x28,0x30))
         
         mask = self.ACR_obj.mask_image
 
-        x_pts, y_pts = self.find_wedges(img, mask, res)
+        x_pts, y_pts = self.find_wedges(img, self.mask_u8, res)
 
-        line_prof_L = skimage.measure.profile_line(
-            img, (y_pts[0], x_pts[0]), (y_pts[1], x_pts[0]), mode="constant"
-        ).flatten()  # line profile through left wedge
-        line_prof_R = skimage.measure.profile_line(
-            img, (y_pts[0], x_pts[1]), (y_pts[1], x_pts[1]), mode="constant"
-        ).flatten()  # line profile through right wedge
+        # vertical line profiles through the wedges, read directly as the wedge points are integer pixel
+        # coordinates (stop at y_pts[1] + 1 to include the end point, as profile_line does)
+        line_prof_L = img[y_pts[0] : y_pts[1] + 1, x_pts[0]].astype(
+            np.float32
+        )  # line profile through left wedge
+        line_prof_R = img[y_pts[0] : y_pts[1] + 1, x_pts[1]].astype(
+            np.float32
+        )  # line profile through right wedge
 
         interp_factor = 5
-        x = np.arange(1, len(line_prof_L) + 1)
-        new_x = np.arange(
-            1, len(line_prof_L) + (1 / interp_factor), (1 / interp_factor)
-        )
+        # pixel positions and upsampled positions along the line profiles, the latter built from an integer
+        # count so that it always ends exactly on the last pixel
+        x = np.arange(len(line_prof_L))
+        new_x = np.arange((len(line_prof_L) - 1) * interp_factor + 1) / interp_factor
 
         # interpolate left line profile
-        interp_line_prof_L = scipy.interpolate.interp1d(x, line_prof_L)(new_x)
+        interp_line_prof_L = np.interp(new_x, x, line_prof_L)
 
         # interpolate right line profile
-        interp_line_prof_R = scipy.interpolate.interp1d(x, line_prof_R)(new_x)
+        interp_line_prof_R = np.interp(new_x, x, line_prof_R)
 
         # difference of line profiles
         delta = interp_line_prof_L - interp_line_prof_R
+        abs_delta = np.abs(delta)
         peaks, _ = ACRObject.find_n_highest_peaks(
-            abs(delta), 1, 0.5 * np.max(abs(delta))
+            abs_delta, 1, 0.5 * abs_delta.max()
         )  # find two highest peaks
 
-        import matplotlib.pyplot as plt
-
-        #plt.close()
-        #plt.plot(abs(delta))
-        #plt.axvline(x=peaks[0])
-        #plt.axvline(x=peaks[1])
-        #plt.imshow(img)
-        #plt.plot([x_pts[0], x_pts[0]], [y_pts[0], y_pts[1]], "b")
-        #plt.plot([x_pts[1], x_pts[1]], [y_pts[0], y_pts[1]], "r")
-        #plt.savefig("test.png")
-
         # if only one peak, set dummy range
         #if len(peaks) == 1:
         peaks = [peaks[0] - 10, peaks[0] + 10]
 
         # set multiplier for right or left shift based on sign of peak
-        pos = (
-            1
-            if np.max(-delta[peaks[0] : peaks[1]]) < np.max(delta[peaks[0] : peaks[1]])
-            else -1
-        )
+        delta_peak = delta[peaks[0] : peaks[1]]
+        pos = 1 if -delta_peak.min() < delta_peak.max() else -1  # max(-delta) is -min(delta)
 
         # take line profiles in range of interest
         static_line_L = interp_line_prof_L[peaks[0] : peaks[1]]
@@ -282,36 +288,42 @@ class ACRSlicePosition(HazenTask):
         # create array of lag values
         lag = np.linspace(-50, 50, 101, dtype=int)
 
-        # initialise array of errors
-        err = np.zeros(len(lag))
-
-        for k, lag_val in enumerate(lag):
-            difference = static_line_R - np.roll(
-                static_line_L, lag_val
-            )  # difference of L and circularly shifted R
-            # set wrapped values to nan
-            if lag_val > 0:
-                difference[:lag_val] = np.nan
-            else:
-                difference[lag_val:] = np.nan
-            # filler value to suppress warning when trying to calculate mean of array filled with NaN otherwise
-            # calculate difference
-            err[k] = 1e10 if np.isnan(difference).all() else np.abs(np.nanmean(difference))
+        # only lags that leave part of the profiles overlapping can give a valid error (no values are kept for a
+        # lag of zero), the rest keep a filler value
+        N = len(static_line_L)
+        overlap = (lag != 0) & (np.abs(lag) < N)
+        overlap_lag = lag[overlap][:, None]
+        err = np.full(len(lag), 1e10)
+
+        # circularly shifted copies of L, one row per overlapping lag value
+        pixel_idx = np.arange(N)[None, :]
+        shifted_L = static_line_L[(pixel_idx - overlap_lag) % N]
+        difference = static_line_R[None, :] - shifted_L  # difference of L and circularly shifted R
+
+        # zero the wrapped values and calculate mean difference over the N - |lag| remaining ones for each lag
+        wrapped = np.where(
+            overlap_lag > 0, pixel_idx < overlap_lag, pixel_idx >= N + overlap_lag
+        )
+        difference[wrapped] = 0
+        err[overlap] = np.abs(np.sum(difference, 1) / (N - np.abs(lag[overlap])))
 
-        # find minimum non-zero error
-        temp = np.argwhere(err == np.min(err[err > 0]))[0]
+        # find (first) minimum non-zero error
+        temp = int(np.argmin(np.where(err > 0, err, np.inf)))
 
         # find shift corresponding to above error
-        shift = -lag[temp][0] if pos == 1 else lag[temp][0]
+        shift = -lag[temp] if pos == 1 else lag[temp]
 
         # calculate bar length difference
         dL = pos * np.abs(shift) * (1 / interp_factor) * res[1]
 
         if self.report:
-            import matplotlib.pyplot as plt
+            # relative position (mm) along the interpolated line profiles
+            rel_pos = np.arange(1, len(interp_line_prof_L) + 1, dtype=np.float64) * (
+                res[1] / interp_factor
+            )
 
             fig, axes = plt.subplots(4, 1)
-            fig.set_size_inches(8, 32)
+            fig.set_size_inches(8, 16)
             fig.tight_layout(pad=4)
 
             axes[0].imshow(img)
@@ -327,16 +339,12 @@ class ACRSlicePosition(HazenTask):
 
             axes[2].grid()
             axes[2].plot(
-                (1 / interp_factor)
-                * np.linspace(1, len(interp_line_prof_L), len(interp_line_prof_L))
-                * res[1],
+                rel_pos,
                 interp_line_prof_L,
                 "b",
             )
             axes[2].plot(
-                (1 / interp_factor)
-                * np.linspace(1, len(interp_line_prof_R), len(interp_line_prof_R))
-                * res[1],
+                rel_pos,
                 interp_line_prof_R,
                 "r",
                 label=f"Right wedge",
@@ -356,9 +364,7 @@ class ACRSlicePosition(HazenTask):
             axes[2].set_xlabel("Relative Pixel Position (mm)")
             axes[2].legend(loc="best")
             axes[3].plot(
-                (1 / interp_factor)
-                * np.linspace(1, len(interp_line_prof_L), len(interp_line_prof_L))
-                * res[1],
+                rel_pos,
                 interp_line_prof_L,
                 "b",
             )
@@ -375,9 +381,7 @@ class ACRSlicePosition(HazenTask):
 
             axes[3].grid()
             axes[3].plot(
-                (1 / interp_factor)
-                * np.linspace(1, len(interp_line_prof_L), len(interp_line_prof_L))
-                * res[1],
+                rel_pos,
                 shift_line,
                 "r",
             )
@@ -387,8 +391,9 @@ class ACRSlicePosition(HazenTask):
             img_path = os.path.realpath(
                 os.path.join(self.report_path, f"{self.img_desc(dcm)}.png")
             )
-            fig.savefig(img_path)
+            fig.savefig(img_path, dpi=100)
             self.report_files.append(img_path)
-            plt.close()
+            fig.clear()
+            plt.close(fig)
 
         return dL
@@ -2,6 +2,7 @@ import os
 import unittest
 import pathlib
 import pydicom
+import numpy as np
 
 from hazenlib.utils import get_dicom_files
 from hazenlib.tasks.acr_slice_position import ACRSlicePosition
@@ -48,6 +49,19 @@ class TestACRSlicePositionSiemens(unittest.TestCase):
             self.acr_slice_position_task.find_wedges(img, mask, res)[1] == self.y_pts[1]
         ).all() == True
 
+    def test_mask_bounds(self):
+        mask = self.acr_slice_position_task.ACR_obj.mask_image
+        w_point = np.argwhere(np.sum(mask, 0) > 0)[0].item()
+        e_point = np.argwhere(np.sum(mask, 0) > 0)[-1].item()
+        n_point = np.argwhere(np.sum(mask, 1) > 0)[0].item()
+
+        assert self.acr_slice_position_task.get_mask_bounds(mask) == (
+            w_point,
+            e_point,
+            n_point,
+        )
+        assert self.acr_slice_position_task.mask_bounds_source is mask
+
     def test_slice_position(self):
         slice_position_val_1 = round(
             self.acr_slice_position_task.get_slice_position(self.dcm_1), 2